@@ -0,0 +1,24 @@
+from typing import Any
+
+
+def window_history(messages: list[dict[str, Any]], max_messages: int, max_chars: int) -> list[dict[str, Any]]:
+    # Cortex Analyst expects alternating turns that start and end with a user message.
+    # Walk back from the newest message, skipping any that break the alternation (e.g. a
+    # user message whose answer failed), and stop at the message or character budget.
+    window = []
+    total = 0
+    expected = "user"
+    for msg in reversed(messages):
+        if msg["role"] != expected:
+            continue
+        size = sum(len(part["text"]) for part in msg["content"])
+        if window and (len(window) >= max_messages or total + size > max_chars):
+            break
+        window.append(msg)
+        total += size
+        expected = "analyst" if expected == "user" else "user"
+    # The oldest message kept must be a user turn.
+    if window and window[-1]["role"] != "user":
+        window.pop()
+    window.reverse()
+    return window
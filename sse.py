@@ -0,0 +1,55 @@
+from itertools import chain
+from typing import Iterable, Iterator, NamedTuple
+
+
+class ServerSentEvent(NamedTuple):
+    event: str
+    data: bytes  # left undecoded; orjson parses bytes directly
+
+
+def parse_sse(block: bytes) -> ServerSentEvent:
+    event = "message"
+    data = []
+    for line in block.split(b"\n"):
+        field, _, value = line.partition(b":")
+        if value.startswith(b" "):
+            value = value[1:]
+        if field == b"event":
+            event = value.decode()
+        elif field == b"data":
+            data.append(value)
+    return ServerSentEvent(event, b"\n".join(data))
+
+
+def iter_sse(chunks: Iterable[bytes]) -> Iterator[ServerSentEvent]:
+    buffer = b""
+    pending_cr = False
+    # The trailing None flushes a \r held back from the last chunk.
+    for chunk in chain(chunks, [None]):
+        if chunk is None:
+            if not pending_cr:
+                return
+            chunk, pending_cr = b"\n", False
+        else:
+            # SSE lines may end in \r\n, \n or \r; normalize to \n. A trailing \r is
+            # held back because it may be the first half of a \r\n split across chunks.
+            if pending_cr:
+                chunk = b"\r" + chunk
+            pending_cr = chunk.endswith(b"\r")
+            if pending_cr:
+                chunk = chunk[:-1]
+            if b"\r" in chunk:
+                chunk = chunk.replace(b"\r\n", b"\n").replace(b"\r", b"\n")
+        # The leftover buffer holds no boundary, so only its last byte can start one;
+        # resume there instead of rescanning an event that spans many chunks.
+        scan = max(0, len(buffer) - 1)
+        buffer += chunk
+        # Scan by offset and trim once per chunk instead of re-slicing per event.
+        start = 0
+        while (end := buffer.find(b"\n\n", max(start, scan))) != -1:
+            event = parse_sse(buffer[start:end])
+            start = end + 2
+            # Comment-only and empty blocks carry no data and are not dispatched.
+            if event.data:
+                yield event
+        buffer = buffer[start:]
@@ -1,13 +1,61 @@
-import json
-import re
-from typing import Any, Generator, Iterator
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack, closing, contextmanager
+from typing import Any, Callable, Generator, Iterator, TypeVar
 
+import httpx
+import orjson
 import pandas as pd
-import requests
+import pyarrow as pa
 import snowflake.connector
-import sseclient
 import streamlit as st
 
+from conversation import window_history
+from sse import ServerSentEvent, iter_sse
+
+T = TypeVar("T")
+
+logger = logging.getLogger(__name__)
+
+SNOWFLAKE_NETWORK_TIMEOUT = 300  # seconds
+HTTP_CONNECT_TIMEOUT = 10  # seconds
+MAX_HISTORY_MESSAGES = 21  # the new question plus the last 10 exchanges
+MAX_HISTORY_CHARS = 128_000  # roughly a 32k-token budget
+MAX_RESULT_ROWS = 10_000
+MAX_SQL_WORKERS = 4
+SSE_PREFETCH_SIZE = 256  # events read ahead of the renderer
+STREAM_FLUSH_INTERVAL = 0.05  # seconds, i.e. at most 20 UI updates per second
+
+
+def get_connection(user: str, password: str) -> snowflake.connector.SnowflakeConnection:
+    return snowflake.connector.connect(
+        user=user,
+        password=password,
+        account="NIBRWBR-MANA",
+        warehouse="COMPUTE_WH",
+        role="SALESFORCEDB",
+        database="SALESFORCE_DB",
+        schema="SALESFORCE",
+        network_timeout=SNOWFLAKE_NETWORK_TIMEOUT,
+        # Keep the session alive for long conversations instead of letting it expire.
+        client_session_keep_alive=True,
+        client_session_keep_alive_heartbeat_frequency=900,
+    )
+
+
+def get_http_client() -> httpx.Client:
+    # Kept per session rather than in cache_resource so cookies are never shared between users.
+    if "http_client" not in st.session_state:
+        # Per-operation limits only: a long answer keeps streaming, but a stalled
+        # stream, connect or pool wait eventually times out.
+        st.session_state.http_client = httpx.Client(
+            timeout=httpx.Timeout(SNOWFLAKE_NETWORK_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT)
+        )
+    return st.session_state.http_client
+
 
 def login_screen():
     st.title("🔐 Login to Snowflake")
@@ -27,16 +75,7 @@ def login_screen():
         full_password = password + mfa_code.strip() if mfa_code else password
 
         try:
-            conn = snowflake.connector.connect(
-                user=user,
-                password=full_password,
-                account="NIBRWBR-MANA",
-                warehouse="COMPUTE_WH",
-                role="SALESFORCEDB",
-                database="SALESFORCE_DB",
-                schema="SALESFORCE"
-            )
-            st.session_state.conn = conn
+            st.session_state.conn = get_connection(user, full_password)
             st.session_state.logged_in = True
             st.rerun()
         except Exception as e:
@@ -48,53 +87,111 @@ def login_screen():
 # ------------- Cortex Analyst Logic ------------- #
 
 def get_conversation_history() -> list[dict[str, Any]]:
-    messages = []
-    for msg in st.session_state.messages:
-        m = {"role": msg["role"], "content": []}
-        for content in msg["content"]:
-            if isinstance(content, pd.DataFrame) or isinstance(content, Exception):
-                continue
-            else:
-                m["content"].append({"type": "text", "text": content})
-        messages.append(m)
-    return messages
+    # Message parts are tagged ("text", "df", "warn" or "err") when they are appended.
+    history = [
+        {
+            "role": msg["role"],
+            "content": [{"type": "text", "text": value} for kind, value in msg["content"] if kind == "text"],
+        }
+        for msg in st.session_state.messages
+    ]
+    return window_history(history, MAX_HISTORY_MESSAGES, MAX_HISTORY_CHARS)
 
 
-def send_message() -> requests.Response:
+def send_message() -> httpx.Response:
     request_body = {
         "messages": get_conversation_history(),
         "semantic_model_file": "@SALESFORCE_DB.SALESFORCE.PAYMENTS/payment_model.smd",  # Update as needed
         "stream": True,
     }
-    resp = requests.post(
+    client = get_http_client()
+    request = client.build_request(
+        "POST",
         url=f"https://{st.session_state.conn.host}/api/v2/cortex/analyst/message",
-        json=request_body,
+        content=orjson.dumps(request_body),
         headers={"Content-Type": "application/json"},
-        stream=True,
     )
+    resp = client.send(request, stream=True)
     if resp.status_code < 400:
         return resp
     else:
+        resp.read()
+        resp.close()
         raise Exception(f"Failed request with status {resp.status_code}: {resp.text}")
 
 
-def stream_events(events: Iterator[sseclient.Event]) -> Generator[Any, Any, Any]:
+@contextmanager
+def prefetch(
+    items: Iterator[T], close: Callable[[], None], maxsize: int = SSE_PREFETCH_SIZE
+) -> Iterator[Iterator[T]]:
+    # Read ahead on a worker thread while the script thread renders. The bounded
+    # queue stalls the reader, and with it the socket, when rendering falls behind.
+    # The reader owns the underlying stream and calls close() itself, so the
+    # stream is never touched from two threads; on exit it is joined.
+    pending = queue.Queue(maxsize=maxsize)
+    stopped = threading.Event()
+
+    def put(kind: str, value: Any) -> bool:
+        while not stopped.is_set():
+            try:
+                pending.put((kind, value), timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def read() -> None:
+        try:
+            for item in items:
+                if not put("item", item):
+                    return
+        except Exception as e:
+            put("error", e)
+        else:
+            put("end", None)
+        finally:
+            close()
+
+    def drain() -> Generator[T, Any, Any]:
+        while True:
+            kind, value = pending.get()
+            if kind == "end":
+                return
+            if kind == "error":
+                raise value
+            yield value
+
+    reader = threading.Thread(target=read, daemon=True)
+    reader.start()
+    try:
+        yield drain()
+    finally:
+        stopped.set()
+        # A reader blocked on the socket wakes up with the next event or at the
+        # client's read timeout, so this can block the script for up to
+        # SNOWFLAKE_NETWORK_TIMEOUT seconds, but not indefinitely.
+        reader.join()
+
+
+def stream_events(events: Iterator[ServerSentEvent], on_sql: Callable[[str], None]) -> Generator[Any, Any, Any]:
     prev_index = -1
     prev_type = ""
     prev_suggestion_index = -1
-    while True:
-        event = next(events, None)
-        if not event:
-            return
-        data = json.loads(event.data)
+    statement = []
+    for event in events:
+        data = orjson.loads(event.data)
         new_block = event.event != "message.content.delta" or data["index"] != prev_index
 
         if prev_type == "sql" and new_block:
+            # Hand the statement off as soon as its block closes, while the rest streams.
+            on_sql("".join(statement))
+            statement.clear()
             yield "\n```\n\n"
         if event.event == "message.content.delta":
             if data["type"] == "sql":
                 if new_block:
                     yield "```sql\n"
+                statement.append(data["statement_delta"])
                 yield data["statement_delta"]
             elif data["type"] == "text":
                 yield data["text_delta"]
@@ -113,67 +210,215 @@ def stream_events(events: Iterator[sseclient.Event]) -> Generator[Any, Any, Any]
         elif event.event == "error":
             st.session_state.error = data
             return
+    # The stream ended without a final status, so the answer can never reach "done".
+    st.session_state.error = {"message": "The response stream ended before the answer was complete."}
+
 
+def throttle_stream(tokens: Iterator[str], interval: float = STREAM_FLUSH_INTERVAL) -> Generator[str, Any, Any]:
+    # Every yield to st.write_stream re-renders the message, so coalesce tokens.
+    buffer = []
+    last_flush = time.monotonic()
+    for token in tokens:
+        buffer.append(token)
+        now = time.monotonic()
+        if now - last_flush >= interval:
+            yield "".join(buffer)
+            buffer.clear()
+            last_flush = now
+    if buffer:
+        yield "".join(buffer)
 
-def display_df(df: pd.DataFrame) -> None:
+
+def display_df(df: pd.DataFrame, table: pa.Table) -> None:
+    # table is the fetched Arrow result, so st.dataframe skips the pandas conversion on every rerun.
     if len(df.index) > 1:
         data_tab, line_tab, bar_tab = st.tabs(["Data", "Line Chart", "Bar Chart"])
-        data_tab.dataframe(df)
-        if len(df.columns) > 1:
-            df = df.set_index(df.columns[0])
+        data_tab.dataframe(table)
+        # Plot against the first column directly instead of copying df via set_index.
+        x = df.columns[0] if len(df.columns) > 1 else None
         with line_tab:
-            st.line_chart(df)
+            st.line_chart(df, x=x)
         with bar_tab:
-            st.bar_chart(df)
+            st.bar_chart(df, x=x)
     else:
-        st.dataframe(df)
+        st.dataframe(table)
+
+
+def fetch_sql(
+    conn: snowflake.connector.SnowflakeConnection, sql: str, on_start: Callable[[str], None]
+) -> Iterator[pa.Table]:
+    # Takes the connection explicitly so it can run outside the script thread.
+    with conn.cursor() as cur:
+        # Submitted asynchronously so the query id is known, and cancellable, while it runs.
+        cur.execute_async(sql)
+        on_start(cur.sfqid)
+        cur.get_results_from_sfqid(cur.sfqid)
+        empty = True
+        for batch in cur.fetch_arrow_batches():
+            empty = False
+            yield batch
+        if empty:
+            # No batches are returned for an empty result; this gives a typed, empty table.
+            yield cur.fetch_arrow_all(force_return_table=True)
+
+
+def unique_names(names: list[str]) -> list[str]:
+    # Joins can select the same column name twice; pandas and the charts need distinct names.
+    used = set()
+    unique = []
+    for name in names:
+        candidate, n = name, 1
+        while candidate in used:
+            n += 1
+            candidate = f"{name}_{n}"
+        used.add(candidate)
+        unique.append(candidate)
+    return unique
+
+
+def fetch_result(
+    conn: snowflake.connector.SnowflakeConnection,
+    sql: str,
+    on_start: Callable[[str], None],
+    partial: queue.Queue,
+) -> tuple[pd.DataFrame, pa.Table, bool]:
+    # Runs on a worker thread. Each batch is also put on partial so the script thread
+    # can paint the result before the query finishes; None marks the end. Downloading
+    # stops once the row cap is exceeded; closing the cursor skips the remaining batches.
+    batches = []
+    num_rows = 0
+    try:
+        with closing(fetch_sql(conn, sql, on_start)) as results:
+            for batch in results:
+                batch = batch.rename_columns(unique_names(batch.column_names))
+                batches.append(batch)
+                partial.put(batch)
+                num_rows += batch.num_rows
+                if num_rows > MAX_RESULT_ROWS:
+                    break
+    finally:
+        partial.put(None)
+    table = pa.concat_tables(batches).slice(0, MAX_RESULT_ROWS)
+    # The fetched table is kept for st.dataframe; the DataFrame built from it feeds the charts.
+    return table.to_pandas(), table, num_rows > MAX_RESULT_ROWS
+
+
+def cancel_queries(conn: snowflake.connector.SnowflakeConnection, query_ids: list[str]) -> None:
+    # Best effort: cancelling a query that already finished is a no-op.
+    for query_id in query_ids:
+        try:
+            with conn.cursor() as cur:
+                cur.execute("SELECT SYSTEM$CANCEL_QUERY(%s)", (query_id,))
+        except Exception:
+            logger.warning("Failed to cancel query %s", query_id, exc_info=True)
 
 
 def process_message(prompt: str) -> None:
-    st.session_state.messages.append({"role": "user", "content": [prompt]})
+    st.session_state.messages.append({"role": "user", "content": [("text", prompt)]})
     with st.chat_message("user"):
         st.markdown(prompt)
 
     accumulated_content = []
-    with st.chat_message("assistant"):
+    executed_sql = set()
+    sql_queries = []  # (partial batches, future) per submitted statement
+    query_ids = []
+    stopping = threading.Event()
+    with st.chat_message("assistant"), ExitStack() as stack:
+        executor = ThreadPoolExecutor(max_workers=MAX_SQL_WORKERS)
+        conn = st.session_state.conn
+
+        def track_query(query_id: str) -> None:
+            query_ids.append(query_id)
+            # If stop_queries already ran, nothing else will cancel this query.
+            if stopping.is_set():
+                cancel_queries(conn, [query_id])
+
+        def stop_queries() -> None:
+            # Runs on every exit, including an error event or a Streamlit stop/rerun
+            # mid-message: never wait for unwanted results, and stop them in the warehouse.
+            stopping.set()
+            executor.shutdown(wait=False, cancel_futures=True)
+            if not all(future.done() for _, future in sql_queries):
+                cancel_queries(conn, list(query_ids))
+
+        stack.callback(stop_queries)
+
+        def submit_sql(sql: str) -> None:
+            # Run each distinct statement at most once per message.
+            sql = sql.strip()
+            if not sql or sql in executed_sql:
+                return
+            executed_sql.add(sql)
+            partial = queue.Queue()
+            sql_queries.append((partial, executor.submit(fetch_result, conn, sql, track_query, partial)))
+
         with st.spinner("Sending request..."):
             response = send_message()
+        # From here on the prefetch reader thread owns the response and closes it.
+        events = stack.enter_context(prefetch(iter_sse(response.iter_bytes(chunk_size=8192)), response.close))
         st.markdown(f"```request_id: {response.headers.get('X-Snowflake-Request-Id')}```")
-        events = sseclient.SSEClient(response).events()
         while st.session_state.status.lower() != "done":
             with st.spinner(st.session_state.status):
-                written_content = st.write_stream(stream_events(events))
-                accumulated_content.append(written_content)
+                written_content = st.write_stream(throttle_stream(stream_events(events, submit_sql)))
+                accumulated_content.append(("text", written_content))
             if st.session_state.error:
                 st.error(f"Error: {st.session_state.error}", icon="🚨")
-                accumulated_content.append(Exception(st.session_state.error))
+                accumulated_content.append(("err", Exception(st.session_state.error)))
                 st.session_state.error = None
                 st.session_state.status = "Interpreting question"
                 st.session_state.messages.pop()
                 return
 
-            sql_blocks = re.findall(r"```sql\s*(.*?)\s*```", written_content, re.DOTALL | re.IGNORECASE)
-            for sql in sql_blocks:
+            if sql_queries:
+                # Queries started while the text streamed; show them in the order of their SQL blocks.
                 with st.spinner("Executing SQL..."):
-                    df = pd.read_sql(sql, st.session_state.conn)
-                    accumulated_content.append(df)
-                    display_df(df)
+                    for partial, future in sql_queries:
+                        # Paint batches as they arrive, then replace them with the full result.
+                        placeholder = st.empty()
+                        batches = []
+                        while (batch := partial.get()) is not None:
+                            batches.append(batch)
+                            placeholder.dataframe(pa.concat_tables(batches))
+                        del batches
+                        try:
+                            df, table, truncated = future.result()
+                        except Exception as e:
+                            # Report the failed query and keep the results of its siblings.
+                            placeholder.empty()
+                            error = Exception(f"Failed to execute SQL: {e}")
+                            st.error(str(error), icon="🚨")
+                            accumulated_content.append(("err", error))
+                            continue
+                        accumulated_content.append(("df", (df, table)))
+                        with placeholder.container():
+                            display_df(df, table)
+                        if truncated:
+                            warning = f"Showing the first {MAX_RESULT_ROWS:,} rows; the query returned more."
+                            accumulated_content.append(("warn", warning))
+                            st.warning(warning)
+                sql_queries.clear()
 
     st.session_state.status = "Interpreting question"
     st.session_state.messages.append({"role": "analyst", "content": accumulated_content})
 
 
+def show_message(msg: dict[str, Any]) -> None:
+    role = "assistant" if msg["role"] == "analyst" else "user"
+    with st.chat_message(role):
+        for kind, value in msg["content"]:
+            if kind == "df":
+                display_df(*value)
+            elif kind == "err":
+                st.error(str(value), icon="🚨")
+            elif kind == "warn":
+                st.warning(value)
+            else:
+                st.write(value)
+
+
 def show_history() -> None:
     for msg in st.session_state.messages:
-        role = "assistant" if msg["role"] == "analyst" else "user"
-        with st.chat_message(role):
-            for content in msg["content"]:
-                if isinstance(content, pd.DataFrame):
-                    display_df(content)
-                elif isinstance(content, Exception):
-                    st.error(str(content), icon="🚨")
-                else:
-                    st.write(content)
+        show_message(msg)
 
 
 # ----------- Streamlit UI Logic ----------- #
@@ -181,10 +426,15 @@ def show_history() -> None:
 if "logged_in" not in st.session_state:
     st.session_state.logged_in = False
 
+# Configure the page exactly once, before any other st.* call.
+if st.session_state.logged_in:
+    st.set_page_config(page_title="Cortex Analyst - Salesforce Payments", layout="wide")
+else:
+    st.set_page_config(page_title="Snowflake Login")
+
 if not st.session_state.logged_in:
     login_screen()
 else:
-    st.set_page_config(page_title="Cortex Analyst - Salesforce Payments", layout="wide")
     st.title("💬 Cortex Analyst")
     st.markdown("Semantic Model: `PAYMENTS/payment_model.smd`")
 
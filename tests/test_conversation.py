@@ -0,0 +1,51 @@
+from conversation import window_history
+
+
+def message(role, text):
+    return {"role": role, "content": [{"type": "text", "text": text}]}
+
+
+def roles(window):
+    return [msg["role"] for msg in window]
+
+
+def test_window_keeps_short_history():
+    messages = [message("user", "a"), message("analyst", "b"), message("user", "c")]
+    assert window_history(messages, max_messages=21, max_chars=100) == messages
+
+
+def test_window_message_budget_starts_on_user():
+    messages = [message(role, "x") for _ in range(10) for role in ("user", "analyst")] + [message("user", "q")]
+    window = window_history(messages, max_messages=4, max_chars=100)
+    assert roles(window) == ["user", "analyst", "user"]
+    assert window[-1] is messages[-1]
+
+
+def test_window_char_budget_drops_whole_turns():
+    messages = [message("user", "u" * 10), message("analyst", "a" * 50), message("user", "v" * 10),
+                message("analyst", "b" * 50), message("user", "q")]
+    window = window_history(messages, max_messages=21, max_chars=70)
+    assert window == messages[2:]
+
+
+def test_window_always_keeps_latest_question():
+    messages = [message("user", "a"), message("analyst", "b"), message("user", "q" * 500)]
+    assert window_history(messages, max_messages=21, max_chars=100) == messages[2:]
+
+
+def test_window_skips_dangling_user_message():
+    messages = [message("user", "failed"), message("user", "a"), message("analyst", "b"), message("user", "q")]
+    window = window_history(messages, max_messages=21, max_chars=100)
+    assert window == messages[1:]
+
+
+def test_window_budget_after_dangling_user_starts_on_user():
+    messages = [message("user", "a"), message("analyst", "b"), message("user", "failed"),
+                message("user", "c"), message("analyst", "d"), message("user", "q")]
+    window = window_history(messages, max_messages=21, max_chars=3)
+    assert roles(window) == ["user", "analyst", "user"]
+    assert window == messages[3:]
+
+
+def test_window_empty():
+    assert window_history([], max_messages=21, max_chars=100) == []
@@ -0,0 +1,37 @@
+from sse import ServerSentEvent, iter_sse, parse_sse
+
+STREAM = b'event: message.content.delta\ndata: {"index": 0}\n\n: keep-alive\n\nevent: status\ndata: {"status": "done"}\n\n'
+EXPECTED = [
+    ServerSentEvent("message.content.delta", b'{"index": 0}'),
+    ServerSentEvent("status", b'{"status": "done"}'),
+]
+
+
+def test_parse_sse():
+    assert parse_sse(b"event: error\ndata: a\ndata:b\n: comment") == ServerSentEvent("error", b"a\nb")
+    assert parse_sse(b"data: x") == ServerSentEvent("message", b"x")
+
+
+def test_iter_sse_lf():
+    assert list(iter_sse([STREAM])) == EXPECTED
+
+
+def test_iter_sse_crlf():
+    assert list(iter_sse([STREAM.replace(b"\n", b"\r\n")])) == EXPECTED
+
+
+def test_iter_sse_cr():
+    assert list(iter_sse([STREAM.replace(b"\n", b"\r")])) == EXPECTED
+
+
+def test_iter_sse_split_across_chunks():
+    for stream in (STREAM, STREAM.replace(b"\n", b"\r\n"), STREAM.replace(b"\n", b"\r")):
+        chunks = [stream[i:i + 1] for i in range(len(stream))]
+        assert list(iter_sse(chunks)) == EXPECTED
+
+
+def test_iter_sse_event_spanning_many_chunks():
+    payload = b"x" * 10_000
+    stream = b"data: " + payload + b"\n\ndata: y\n\n"
+    chunks = [stream[i:i + 7] for i in range(0, len(stream), 7)]
+    assert list(iter_sse(chunks)) == [ServerSentEvent("message", payload), ServerSentEvent("message", b"y")]